@@ -17,9 +17,11 @@ setup(
         "requests",
         "path.py >= 2.19",
         "bs4",
+        "lxml",
         "awesome-slugify",
         "pyyaml",
     ],
+    extras_require={"speedups": ["deflate >= 0.3", "orjson"]},
     include_package_data=True,
     url="http://github.com/AmauryCarrade/zds-to-grav",
     classifiers=[
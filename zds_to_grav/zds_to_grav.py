@@ -2,25 +2,70 @@
 Utility to convert a Zeste de Savoir article or opinion to the Grav format.
 """
 
-import io
-import json
 import re
 import shutil
+import struct
 import sys
 import os
+import tempfile
+import zlib
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
 from datetime import time, datetime
 from hashlib import sha256
-from zipfile import ZipFile
+from urllib.parse import urlparse
+from zipfile import BadZipFile, ZipFile, ZIP_DEFLATED
 
 import click
 import requests
 import yaml
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 from path import Path
+from requests.adapters import HTTPAdapter
 from slugify import UniqueSlugify
 
+try:
+    import lxml  # noqa: F401
+
+    # lxml is much faster than the pure-Python parser; we fall back to the latter
+    # if it's not available.
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+try:
+    # Faster, and accepts the raw bytes read from the archive, just like json.loads.
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    import deflate
+except ImportError:
+    deflate = None
+
+# The libyaml-based dumper is much faster than the pure-Python one, but is only
+# available if PyYAML was built with libyaml. Both load back to the same values,
+# but the output may differ: libyaml folds long scalars differently, and escapes
+# characters outside of the BMP (like emojis) in double-quoted strings.
+YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+# Entries bigger than that are streamed through zipfile instead of being
+# decompressed in one go.
+LIBDEFLATE_MAX_ENTRY_SIZE = 2 << 20
+
+ZIP_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+ZIP_LOCAL_HEADER_STRUCT = "<4s2B4HL2L2H"
+ZIP_LOCAL_HEADER_SIZE = struct.calcsize(ZIP_LOCAL_HEADER_STRUCT)
+
+# Only the parts of the ZdS page we extract metadata from: the sidebar (download
+# links), the tags list, and the content header (authors, categories, date).
+# The strainer filters on tag names only: while parsing, it would compare classes
+# to the raw class attribute, dropping elements with more than one class.
+zds_page_strainer = SoupStrainer(["aside", "article", "ul"])
+
 
 @click.command()
 @click.option(
@@ -53,6 +98,19 @@ def zds_to_grav(zds_archive, template_name, lang, slug, number, to):
     to an article or an opinion on Zeste de Savoir. URL are preferred as it allows
     to fetch metadata not contained in the archive (tags, categories, authors, date).
     """
+    # All requests are sent to the same few hosts, so connections are kept alive
+    # and reused across the page, archive and images downloads.
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+    # Shared by all sections, so that images filenames are unique in the article,
+    # and that images used multiple times are only stored once.
+    slugify = UniqueSlugify(to_lower=True)
+    downloaded_images = {}
+
+    # Temporary file the content archive is downloaded to, if input by URL.
+    downloaded_archive = None
+
     try:
         tags = []
         categories = []
@@ -79,7 +137,7 @@ def zds_to_grav(zds_archive, template_name, lang, slug, number, to):
 
             link = zds_archive
 
-            r = requests.get(zds_archive)
+            r = session.get(zds_archive)
             if not r.ok:
                 click.secho(
                     f"→ Cannot download Zeste de Savoir webpage: {r.status_code} {r.reason}",
@@ -88,8 +146,7 @@ def zds_to_grav(zds_archive, template_name, lang, slug, number, to):
                 )
                 return
 
-            zds_page = r.text
-            zds_soup = BeautifulSoup(zds_page, "html.parser")
+            zds_soup = parse_zds_page(r.text)
 
             click.secho("→ Retrieving metadata…", fg="yellow")
 
@@ -117,14 +174,14 @@ def zds_to_grav(zds_archive, template_name, lang, slug, number, to):
 
             tags_list = zds_soup.find("ul", class_="taglist")
             if tags_list:
-                for tag in tags_list.find_all("li"):
-                    tags.append(tag.string.strip())
+                tags = [
+                    tag.get_text(strip=True)
+                    for tag in tags_list.find_all("li", recursive=False)
+                ]
 
-            authors_block = (
-                zds_soup.find("article", class_="content-wrapper")
-                .find("header")
-                .find("div", class_="authors")
-            )
+            header = zds_soup.find("article", class_="content-wrapper").find("header")
+
+            authors_block = header.find("div", class_="authors")
             if authors_block:
                 meta_lists = authors_block.find_all("ul")
 
@@ -132,18 +189,18 @@ def zds_to_grav(zds_archive, template_name, lang, slug, number, to):
                 categories_list = meta_lists[1] if len(meta_lists) > 1 else None
 
                 if authors_list:
-                    for author in authors_list.find_all("li"):
-                        authors.append(author.a.span.string.strip())
+                    authors = [
+                        author.a.span.get_text(strip=True)
+                        for author in authors_list.find_all("li", recursive=False)
+                    ]
 
                 if categories_list:
-                    for category in categories_list.find_all("a"):
-                        categories.append(category.string.strip())
+                    categories = [
+                        category.get_text(strip=True)
+                        for category in categories_list.find_all("a")
+                    ]
 
-            date_elem = (
-                zds_soup.find("article", class_="content-wrapper")
-                .find("header")
-                .find("span", class_="pubdate")
-            )
+            date_elem = header.find("span", class_="pubdate")
             if date_elem:
                 date_elem = date_elem.find("time")
                 if date_elem:
@@ -153,17 +210,22 @@ def zds_to_grav(zds_archive, template_name, lang, slug, number, to):
                 f"→ Downloading content archive from {download_link}…", fg="yellow"
             )
 
-            r = requests.get(download_link, stream=True)
+            with session.get(download_link, stream=True) as r:
+                if not r.ok:
+                    click.secho(
+                        f"  Cannot download Zeste de Savoir webpage: {r.status_code} {r.reason}",
+                        fg="red",
+                        bold=True,
+                    )
+                    return
 
-            if not r.ok:
-                click.secho(
-                    f"  Cannot download Zeste de Savoir webpage: {r.status_code} {r.reason}",
-                    fg="red",
-                    bold=True,
-                )
-                return
+                # The archive is streamed to a temporary file instead of being
+                # buffered in memory.
+                downloaded_archive = tempfile.TemporaryFile()
+                r.raw.decode_content = True
+                shutil.copyfileobj(r.raw, downloaded_archive, length=131_072)
 
-            zds_archive = io.BytesIO(r.content)
+            zds_archive = downloaded_archive
 
             if not to:
                 to = os.getcwd()
@@ -174,10 +236,7 @@ def zds_to_grav(zds_archive, template_name, lang, slug, number, to):
         to = to.rstrip("/") + "/"
 
         with ZipFile(zds_archive) as archive:
-            manifest = {}
-
-            with archive.open("manifest.json", "r") as manifest:
-                manifest = json.loads(manifest.read())
+            manifest = json_loads(read_archive_entry(archive, "manifest.json"))
 
             if manifest["version"] < 2:
                 click.secho(
@@ -197,116 +256,182 @@ def zds_to_grav(zds_archive, template_name, lang, slug, number, to):
                 )
                 return
 
-            if not slug:
-                slug = (
-                    manifest["slug"]
-                    if "slug" in manifest
-                    else "unnamed-content-" + str(int(time.time()))
-                )
+            # Sections are small, so they are all read upfront and the archive is
+            # not kept open while the content is processed and images downloaded.
+            introduction = (
+                read_archive_entry(archive, manifest["introduction"])
+                if "introduction" in manifest
+                else None
+            )
+            extracts = [
+                (child["title"], read_archive_entry(archive, child["text"]))
+                for child in manifest.get("children", [])
+                if child["object"] == "extract"
+            ]
+            conclusion = (
+                read_archive_entry(archive, manifest["conclusion"])
+                if "conclusion" in manifest
+                else None
+            )
 
-            if number:
-                to += f"{number:02}."
-            to += slug + "/"
+        if not slug:
+            slug = (
+                manifest["slug"]
+                if "slug" in manifest
+                else "unnamed-content-" + str(int(time.time()))
+            )
 
-            to = Path(to)
-            to.mkdir_p()
+        if number:
+            to += f"{number:02}."
+        to += slug + "/"
 
-            click.secho(
-                f"\nProcessing {manifest['type'].lower()} content…",
-                fg="blue",
-                bold=True,
+        to = Path(to)
+        to.mkdir_p()
+
+        click.secho(
+            f"\nProcessing {manifest['type'].lower()} content…",
+            fg="blue",
+            bold=True,
+        )
+
+        # Sections are (separator, markdown) pairs, in the article order. Line
+        # endings (CRLF and lone CR) are normalized to LF, as archives may come
+        # from Windows or old Macs.
+        sections = []
+
+        if introduction is not None:
+            introduction = (
+                introduction.decode("utf-8")
+                .replace("\r\n", "\n")
+                .replace("\r", "\n")
+                .strip()
+            )
+            sections.append(("", introduction))
+
+        for extract_title, extract in extracts:
+            extract = (
+                extract.decode("utf-8")
+                .replace("\r\n", "\n")
+                .replace("\r", "\n")
+                .strip()
+            )
+            sections.append(
+                (f"\n\n\n# {extract_title}\n\n", shift_markdown_headers(extract))
             )
 
-            markdown_content = ""
+        if conclusion is not None:
+            conclusion = (
+                conclusion.decode("utf-8")
+                .replace("\r\n", "\n")
+                .replace("\r", "\n")
+                .strip()
+            )
+            sections.append(("\n\n\n------\n\n\n", conclusion))
 
-            if "introduction" in manifest:
-                with archive.open(manifest["introduction"]) as introduction:
-                    markdown_content = download_and_replace_markdown_images(
-                        get_content(introduction), to
-                    )
+        # The images of all sections are downloaded concurrently; then, the
+        # sections are processed one after the other, by this thread only.
+        with ThreadPoolExecutor(max_workers=IMAGE_DOWNLOAD_WORKERS) as executor:
+            sections_images = []
 
-            if "children" in manifest:
-                for child in manifest["children"]:
-                    if not child["object"] == "extract":
-                        continue
-                    with archive.open(child["text"]) as extract:
-                        markdown_content += "\n\n\n"
-                        markdown_content += f"# {child['title']}\n\n"
-                        markdown_content += download_and_replace_markdown_images(
-                            shift_markdown_headers(get_content(extract)), to
-                        )
-
-            if "conclusion" in manifest:
-                with archive.open(manifest["conclusion"]) as conclusion:
-                    markdown_content += "\n\n\n------\n\n\n"
-                    markdown_content += download_and_replace_markdown_images(
-                        get_content(conclusion), to
+            try:
+                for _, section in sections:
+                    sections_images.append(
+                        download_markdown_images(section, to, session, executor)
                     )
 
-            # fmt: off
-            markdown_frontmatter = {
-                "title": manifest["title"] if "title" in manifest else f"Unnamed {manifest['type'].lower()}",
-                "abstract": manifest["description"] if "description" in manifest else "",
-                "taxonomy": {
-                    "author": authors, 
-                    "category": categories,
-                    "tag": tags
-                },
-            }
-            # fmt: on
-
-            if date:
-                markdown_frontmatter["date"] = date.strftime("%H:%M %d-%m-%Y")
-
-            if "licence" in manifest:
-                if manifest["licence"].startswith("CC"):
-                    markdown_frontmatter["license"] = (
-                        manifest["licence"].lower().replace("cc ", "")
+                markdown_content = "".join(
+                    separator
+                    + replace_markdown_images(
+                        section, images, to, slugify, downloaded_images
                     )
+                    for (separator, section), images in zip(sections, sections_images)
+                )
+            except BaseException:
+                # If a section fails, the images of the next ones are still
+                # being downloaded.
+                for images in sections_images:
+                    discard_markdown_images(images)
+                raise
+
+        # fmt: off
+        markdown_frontmatter = {
+            "title": manifest["title"] if "title" in manifest else f"Unnamed {manifest['type'].lower()}",
+            "abstract": manifest["description"] if "description" in manifest else "",
+            "taxonomy": {
+                "author": authors, 
+                "category": categories,
+                "tag": tags
+            },
+        }
+        # fmt: on
+
+        if date:
+            markdown_frontmatter["date"] = date.strftime("%H:%M %d-%m-%Y")
+
+        if "licence" in manifest:
+            if manifest["licence"].startswith("CC"):
+                markdown_frontmatter["license"] = (
+                    manifest["licence"].lower().replace("cc ", "")
+                )
 
-            if link:
-                markdown_frontmatter["canonical"] = link
+        if link:
+            markdown_frontmatter["canonical"] = link
 
-            markdown_frontmatter_raw = "---\n"
-            markdown_frontmatter_raw += yaml.dump(
-                markdown_frontmatter,
-                allow_unicode=True,
-                indent=4,
-                default_flow_style=False,
-            )
-            markdown_frontmatter_raw += "---\n\n"
+        markdown_frontmatter_raw = "---\n"
+        markdown_frontmatter_raw += yaml.dump(
+            markdown_frontmatter,
+            Dumper=YAML_DUMPER,
+            allow_unicode=True,
+            indent=4,
+            default_flow_style=False,
+        )
+        markdown_frontmatter_raw += "---\n\n"
 
-            markdown_content = markdown_frontmatter_raw + markdown_content.strip()
+        markdown_content = markdown_frontmatter_raw + markdown_content.strip()
 
-            markdown_filename = to / (
-                template_name + ("." + lang if lang else "") + ".md"
-            )
+        markdown_filename = to / (template_name + ("." + lang if lang else "") + ".md")
 
-            with open(markdown_filename, "w") as markdown_file:
-                markdown_file.write(markdown_content)
+        markdown_filename.write_text(markdown_content, encoding="utf-8", linesep=None)
 
-            click.secho(
-                f"\nMarkdown file wrote to "
-                + click.format_filename(markdown_filename)
-                + " successfully.",
-                fg="green",
-                bold=True,
-            )
+        click.secho(
+            f"\nMarkdown file wrote to "
+            + click.format_filename(markdown_filename)
+            + " successfully.",
+            fg="green",
+            bold=True,
+        )
     except Exception as e:
         click.secho(
             f"Error while processing archive: {e}", err=True, fg="red", bold=True
         )
         raise
+    finally:
+        if downloaded_archive is not None:
+            downloaded_archive.close()
+        session.close()
 
 
-re_title_5 = re.compile(r"(\A|\r?\n)##### (.+)(\r?\n|\Z)")
-re_title_4 = re.compile(r"(\A|\r?\n)#### (.+)(\r?\n|\Z)")
-re_title_3 = re.compile(r"(\A|\r?\n)### (.+)(\r?\n|\Z)")
-re_title_2 = re.compile(r"(\A|\r?\n)## (.+)(\r?\n|\Z)")
-re_title_1 = re.compile(r"(\A|\r?\n)# (.+)(\r?\n|\Z)")
-
-re_title_2_long = re.compile(r"(\A|\r?\n)(.+)\r?\n-{2,}(\r?\n|\Z)")
-re_title_1_long = re.compile(r"(\A|\r?\n)(.+)\r?\n(={2,})(\r?\n|\Z)")
+def parse_zds_page(zds_page):
+    '''
+    Parses the parts of a Zeste de Savoir page containing the content metadata.
+
+    >>> zds_soup = parse_zds_page("""
+    ... <nav><ul class="menu"><li>Menu</li></ul></nav>
+    ... <aside class="sidebar mobile-menu-hide"><a class="download" href="/a.zip"></a></aside>
+    ... <article class="content-wrapper"><header></header></article>
+    ... <ul class="taglist topic-tags"><li>Tag</li></ul>
+    ... <footer>Footer</footer>
+    ... """)
+    >>> zds_soup.find("aside", class_="sidebar").a["href"]
+    '/a.zip'
+    >>> zds_soup.find("ul", class_="taglist").li.string
+    'Tag'
+    >>> zds_soup.find("article", class_="content-wrapper").header
+    <header></header>
+    >>> zds_soup.find("footer") is None
+    True
+    '''
+    return BeautifulSoup(zds_page, HTML_PARSER, parse_only=zds_page_strainer)
 
 
 def shift_markdown_headers(markdown_source):
@@ -342,37 +467,102 @@ def shift_markdown_headers(markdown_source):
     ... --------
     ... """)
     '\\nHeader 1\\n--------\\n\\n### Header 2\\n'
+
+    >>> shift_markdown_headers("# Header 1\\n## Header 2\\n#hashtag")
+    '## Header 1\\n### Header 2\\n#hashtag'
+
+    >>> shift_markdown_headers("Header 1\\n===\\nHeader 2\\n---\\nHeader 2\\n---\\n---")
+    'Header 1\\n---\\n### Header 2\\n### Header 2\\n---'
+
+    >>> shift_markdown_headers("# Header 1\\n---")
+    '## Header 1\\n---'
     '''
-    markdown_source = re_title_5.sub(r"\1###### \2\3", markdown_source)
-    markdown_source = re_title_4.sub(r"\1##### \2\3", markdown_source)
-    markdown_source = re_title_3.sub(r"\1#### \2\3", markdown_source)
-    markdown_source = re_title_2.sub(r"\1### \2\3", markdown_source)
-    markdown_source = re_title_1.sub(r"\1## \2\3", markdown_source)
-
-    markdown_source = re_title_2_long.sub(r"\1### \2\3", markdown_source)
-
-    def repl_title_1_long(match):
-        return (
-            match.group(1)
-            + match.group(2)
-            + "\n"
-            + "-" * len(match.group(3))
-            + match.group(4)
-        )
+    # Lines are scanned one by one; as most of them are not headers, this is
+    # faster than running regular expressions over the whole source.
+    lines = []
+
+    # Whether the previous line may be the text of a setext-style header.
+    previous_is_text = False
+
+    for line in markdown_source.split("\n"):
+        if line.startswith("#"):
+            level = len(line) - len(line.lstrip("#"))
+            if level <= 6 and line[level : level + 1] == " " and line[level + 1 :]:
+                if level < 6:
+                    line = "#" + line
+
+                lines.append(line)
+                previous_is_text = False
+                continue
+
+        line_content = line.rstrip("\r")
+
+        if previous_is_text and len(line_content) >= 2:
+            if not line_content.strip("-"):
+                lines[-1] = "### " + lines[-1]
+                previous_is_text = False
+                continue
+
+            if not line_content.strip("="):
+                lines.append("-" * len(line_content) + line[len(line_content) :])
+                previous_is_text = False
+                continue
 
-    markdown_source = re_title_1_long.sub(repl_title_1_long, markdown_source)
+        lines.append(line)
+        previous_is_text = bool(line_content)
 
-    return markdown_source
+    return "\n".join(lines)
 
 
 re_image = re.compile(r"!\[([^\]]+)\]\(([^\)]+)\)")
-slugify = UniqueSlugify(to_lower=True)
 
-downloaded_images = {}
+# Images are downloaded concurrently, by at most this amount of threads.
+IMAGE_DOWNLOAD_WORKERS = 8
 
+# Images with other extensions in their URL are not downloaded.
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif", ".webp", ".svg"}
 
-def download_and_replace_markdown_images(markdown_source, to):
-    def repl_and_download_image(match):
+# Images are downloaded to private temporary files; once moved to their final
+# name, they get the mode any new file would (e.g. 0644), so that the web server
+# can read them.
+UMASK = os.umask(0)
+os.umask(UMASK)
+IMAGE_FILE_MODE = 0o666 & ~UMASK
+
+
+def image_extension(image_url):
+    """
+    Returns the extension of an image URL, or None if it doesn't look like one.
+
+    >>> image_extension("https://zestedesavoir.com/media/galleries/1/image.png")
+    '.png'
+    >>> image_extension("https://example.com/image.png?v=2#top")
+    '.png'
+    >>> image_extension("https://example.com/IMAGE.PNG")
+    '.png'
+    >>> image_extension("https://example.com/image") is None
+    True
+    >>> image_extension("https://example.com/page.html") is None
+    True
+    """
+    image_ext = os.path.splitext(urlparse(image_url).path)[1].lower()
+    return image_ext if image_ext in IMAGE_EXTENSIONS else None
+
+
+def download_markdown_images(markdown_source, to, session, executor):
+    """
+    Starts downloading the images of a markdown source, using the executor.
+
+    Returns a list of (match, alt, URL, extension, download) tuples, one per
+    image, to pass to replace_markdown_images. The download is a future for
+    download_image's result, or None if the image is not to be downloaded.
+    """
+    if "![" not in markdown_source:
+        return []
+
+    images = []
+
+    for match in re_image.finditer(markdown_source):
         image_alt = match.group(1)
         image_url = match.group(2)
 
@@ -382,53 +572,254 @@ def download_and_replace_markdown_images(markdown_source, to):
             if image_url.startswith("/"):
                 image_url = "https://zestedesavoir.com" + image_url
             else:
-                click.echos(
+                click.secho(
                     f"→ Skipping image download for {image_url} (don't know where to fetch it).",
                     err=True,
                 )
-                return match.group(0)
+                image_url = None
 
-        click.secho(
-            f"→ Downloading and replacing image “"
-            + click.style(image_alt, bold=True)
-            + click.style("”…", fg="yellow"),
-            fg="yellow",
+        image_ext = None
+        if image_url:
+            image_ext = image_extension(image_url)
+            if not image_ext:
+                click.secho(
+                    f"→ Skipping image download for {image_url} (not an image).",
+                    err=True,
+                )
+                image_url = None
+
+        download = (
+            executor.submit(download_image, session, image_url, to)
+            if image_url
+            else None
         )
-        click.secho(f"  {image_url}", dim=True)
-
-        r = requests.get(image_url, stream=True)
-        if not r.ok:
-            click.secho("  Unable to download image, skipping", err=True, fg="red")
-            return match.group(0)
-
-        image = io.BytesIO(r.content)
-        image_hash = sha256(image.read()).hexdigest()
-        image_ext = "." + image_url.split(".")[-1]
-
-        if image_hash in downloaded_images:
-            image_filename = downloaded_images[image_hash]
-            image_is_new = False
-        else:
-            # Filename: slug of the first sentence of the alt-text, limited to 20 words because of
-            # the max path size.
-            image_filename = (
-                slugify(" ".join(image_alt.split(".")[0].split()[:20])) + image_ext
+
+        images.append((match, image_alt, image_url, image_ext, download))
+
+    return images
+
+
+def replace_markdown_images(markdown_source, images, to, slugify, downloaded_images):
+    """
+    Replaces the images of a markdown source by their downloaded version, waiting
+    for their downloads to complete.
+
+    Images are processed in order, and the slugifier and downloaded images cache
+    are only to be used from one thread.
+
+    >>> from concurrent.futures import Future
+    >>> to = Path(tempfile.mkdtemp())
+    >>> markdown_source = "Lorem ![An image](https://example.com/image.png) ipsum"
+    >>> with tempfile.NamedTemporaryFile(dir=to, delete=False) as image_file:
+    ...     _ = image_file.write(b"PNG")
+    >>> download = Future()
+    >>> download.set_result(("hash", image_file.name))
+    >>> images = [
+    ...     (
+    ...         re_image.search(markdown_source),
+    ...         "An image",
+    ...         "https://example.com/image.png",
+    ...         ".png",
+    ...         download,
+    ...     )
+    ... ]
+    >>> slugify = UniqueSlugify(to_lower=True)
+    >>> replace_markdown_images(markdown_source, images, to, slugify, {})
+    → Downloading and replacing image “An image”…
+      https://example.com/image.png
+    'Lorem ![An image](an-image.png) ipsum'
+    >>> (to / "item.md").write_text("", encoding="utf-8")
+    >>> (to / "an-image.png").stat().st_mode == (to / "item.md").stat().st_mode
+    True
+    >>> shutil.rmtree(to)
+    """
+    if not images:
+        return markdown_source
+
+    markdown_chunks = []
+    last_end = 0
+
+    try:
+        for match, image_alt, image_url, image_ext, download in images:
+            markdown_chunks.append(markdown_source[last_end : match.start()])
+            last_end = match.end()
+
+            if not download:
+                markdown_chunks.append(match.group(0))
+                continue
+
+            click.secho(
+                f"→ Downloading and replacing image “"
+                + click.style(image_alt, bold=True)
+                + click.style("”…", fg="yellow"),
+                fg="yellow",
             )
-            image_is_new = True
-            downloaded_images[image_hash] = image_filename
+            click.secho(f"  {image_url}", dim=True)
+
+            image = download.result()
+            if image is None:
+                click.secho("  Unable to download image, skipping", err=True, fg="red")
+                markdown_chunks.append(match.group(0))
+                continue
+
+            image_hash, image_temp_filename = image
 
-        if image_is_new:
-            image.seek(0)
-            with open(to / image_filename, "wb") as f:
-                shutil.copyfileobj(image, f, length=131_072)
+            if image_hash in downloaded_images:
+                image_filename = downloaded_images[image_hash]
+                image_is_new = False
+            else:
+                # Filename: slug of the first sentence of the alt-text, limited to 20 words because of
+                # the max path size.
+                image_filename = (
+                    slugify(" ".join(image_alt.split(".")[0].split()[:20])) + image_ext
+                )
+                image_is_new = True
+                downloaded_images[image_hash] = image_filename
+
+            if image_is_new:
+                os.replace(image_temp_filename, to / image_filename)
+                os.chmod(to / image_filename, IMAGE_FILE_MODE)
+            else:
+                os.remove(image_temp_filename)
+
+            markdown_chunks.append(f"![{image_alt}]({image_filename})")
+    except BaseException:
+        # Downloads not processed yet would otherwise leave their temporary
+        # files in the content directory.
+        discard_markdown_images(images)
+        raise
+
+    markdown_chunks.append(markdown_source[last_end:])
+
+    return "".join(markdown_chunks)
+
+
+def discard_markdown_images(images):
+    """
+    Cancels the pending downloads of images returned by download_markdown_images,
+    waits for the running ones, and removes the temporary files of the images
+    not processed by replace_markdown_images.
+    """
+    downloads = [download for *_, download in images if download]
+
+    for download in downloads:
+        download.cancel()
+
+    for download in downloads:
+        if download.cancelled():
+            continue
+
+        try:
+            image = download.result()
+        except Exception:
+            continue
+
+        # Images already processed were moved or removed.
+        if image is not None:
+            with suppress(FileNotFoundError):
+                os.remove(image[1])
+
+
+def download_image(session, image_url, to):
+    """
+    Downloads an image to a temporary file in the `to` directory, hashing it
+    on the fly.
+
+    Returns a tuple with the SHA-256 hex digest of the image and the temporary
+    file name, or None if the image cannot be downloaded.
+    """
+    with session.get(image_url, stream=True) as r:
+        # Dead links often lead to an HTML error page; in this case, the body is
+        # not downloaded at all.
+        if not r.ok or r.headers.get("Content-Type", "").startswith("text/html"):
+            return None
+
+        image_hash = sha256()
+
+        with tempfile.NamedTemporaryFile(dir=to, delete=False) as f:
+            try:
+                for chunk in r.iter_content(chunk_size=131_072):
+                    image_hash.update(chunk)
+                    f.write(chunk)
+            except BaseException:
+                f.close()
+                os.remove(f.name)
+                raise
+
+    return image_hash.hexdigest(), f.name
+
+
+def read_archive_entry(archive, name):
+    """
+    Reads an entry of the archive and returns its (uncompressed) content.
+
+    Small deflated entries are decompressed in one go using libdeflate, if
+    available; other entries are read through the zipfile module. Either way,
+    the content is returned as bytes, and corrupted entries raise BadZipFile.
+
+    >>> import io
+    >>> from zipfile import ZIP_STORED
+    >>> archive_file = io.BytesIO()
+    >>> with ZipFile(archive_file, "w") as archive:
+    ...     archive.writestr("manifest.json", '{"version": 2}' * 10, ZIP_DEFLATED)
+    ...     archive.writestr("stored.md", "Lorem ipsum", ZIP_STORED)
+    ...     archive.writestr("introduction-é.md", "Dolor sit amet" * 10, ZIP_DEFLATED)
+    >>> with ZipFile(archive_file) as archive:
+    ...     for name in archive.namelist():
+    ...         content = read_archive_entry(archive, name)
+    ...         print(name, type(content).__name__, content == archive.read(name))
+    manifest.json bytes True
+    stored.md bytes True
+    introduction-é.md bytes True
+
+    >>> corrupted_file = io.BytesIO(b"XXXX" + archive_file.getvalue()[4:])
+    >>> with ZipFile(corrupted_file) as archive:
+    ...     read_archive_entry(archive, "manifest.json")
+    Traceback (most recent call last):
+    ...
+    zipfile.BadZipFile: Bad magic number for file header
+    """
+    info = archive.getinfo(name)
+
+    if (
+        deflate is None
+        or info.compress_type != ZIP_DEFLATED
+        or info.flag_bits & 0x1  # encrypted
+        or info.file_size > LIBDEFLATE_MAX_ENTRY_SIZE
+    ):
+        return archive.read(name)
+
+    # The compressed data starts after the local file header, whose name and
+    # extra fields lengths may differ from the ones in the central directory.
+    # As zipfile, the header signature and file name are checked not to
+    # decompress anything else than the entry if the archive is corrupted.
+    archive.fp.seek(info.header_offset)
+    local_header = archive.fp.read(ZIP_LOCAL_HEADER_SIZE)
+    if len(local_header) != ZIP_LOCAL_HEADER_SIZE:
+        raise BadZipFile("Truncated file header")
+
+    local_header = struct.unpack(ZIP_LOCAL_HEADER_STRUCT, local_header)
+    if local_header[0] != ZIP_LOCAL_HEADER_SIGNATURE:
+        raise BadZipFile("Bad magic number for file header")
+
+    local_name = archive.fp.read(local_header[-2])
+    local_name = local_name.decode("utf-8" if info.flag_bits & 0x800 else "cp437")
+    if local_name != info.orig_filename:
+        raise BadZipFile(
+            f"File name in directory {info.orig_filename!r} and header {local_name!r} differ."
+        )
 
-        return f"![{image_alt}]({image_filename})"
+    archive.fp.seek(local_header[-1], os.SEEK_CUR)
 
-    return re_image.sub(repl_and_download_image, markdown_source)
+    content = deflate.deflate_decompress(
+        archive.fp.read(info.compress_size), info.file_size
+    )
 
+    if zlib.crc32(content) != info.CRC:
+        raise BadZipFile(f"Bad CRC-32 for file {name!r}")
 
-def get_content(f):
-    return "".join([line for line in io.TextIOWrapper(io.BytesIO(f.read()))]).strip()
+    # libdeflate returns a bytearray.
+    return bytes(content)
 
 
 if __name__ == "__main__":